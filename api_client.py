@@ -0,0 +1,30 @@
+import streamlit as st
+import openai
+import requests
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+# Connection budget for the shared sync and async HTTP sessions
+HTTP_CONCURRENCY = 10
+
+# One pooled HTTP session for every OpenAI and image request, kept across reruns so
+# connections (and their TLS handshakes) are reused instead of rebuilt per call
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    # Room for every concurrent call in a character bundle to keep its own warm connection
+    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_CONCURRENCY, pool_maxsize=2 * HTTP_CONCURRENCY)
+    session.mount("https://", adapter)
+    return session
+
+openai.requestssession = get_http_session()
+
+# Every API call gets a timeout, and rate limits or transient failures are retried with backoff
+# instead of stalling or failing the rerun; any other error is raised straight away
+REQUEST_TIMEOUT = 30
+api_retry = retry(
+    wait=wait_exponential_jitter(initial=1, max=20),
+    stop=stop_after_attempt(4),
+    retry=retry_if_exception_type((openai.error.RateLimitError, openai.error.Timeout, openai.error.APIConnectionError,
+                                   openai.error.ServiceUnavailableError, openai.error.TryAgain)),
+    reraise=True,
+)
@@ -1,348 +1,65 @@
 import random
+import hashlib
+from functools import partial
 import streamlit as st
 import json
+import orjson
 import openai
-import os
 from io import BytesIO
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import simpleSplit, ImageReader
-import base64
-import requests
+from constants import races, classes, backgrounds, genders, image_styles, themes, portrait_qualities
+from generators import (generate_character, build_character_bundle, run_async, run_in_background, generate_theme_song, generate_theme_songs, stream_party_story, continue_party_stories, stream_character_history,
+                        forget_character_images, character_text_requests, submit_character_batch, check_character_batches, template_npc, template_quest,
+                        submit_names_batch, check_names_batch, initialize_world, add_to_region, generate_world_journals,
+                        submit_lore_batch, check_lore_batch,
+                        cached_chat, SYS_REGION)
+from exporters import save_journal, create_journal_pdf, create_pdf, wrap_text
 
 # Load OpenAI key securely
 openai.api_key = st.secrets["OPENAI_API_KEY"]
 
 
 # Initialize session state
-if "characters" not in st.session_state:
-    st.session_state.characters = []
-if "parties" not in st.session_state:
-    st.session_state.parties = []
-if "stories" not in st.session_state:
-    st.session_state.stories = []
-if "worlds" not in st.session_state:
-    st.session_state.worlds = []
-if "journals" not in st.session_state:
-    st.session_state.journals = []
-if "regions" not in st.session_state: 
-    st.session_state.regions = []
-# Character traits
-races = ["Human", "Elf", "Dwarf", "Halfling", "Gnome", "Half-Orc", "Tiefling", "Dragonborn", "Kobold", "Lizardfolk", "Minotaur", "Troll", "Vampire", "Satyr", "Undead", "Lich", "Werewolf"]
-classes = ["Fighter", "Wizard", "Rogue", "Cleric", "Barbarian", "Sorcerer", "Bard", "Monk", "Druid", "Ranger", "Paladin", "Warlock", "Artificer", "Blood Hunter", "Mystic", "Warden", "Berserker", "Necromancer", "Trickster", "Beast Master", "Alchemist", "Pyromancer", "Dark Knight"]
-backgrounds = ["Acolyte", "Folk Hero", "Sage", "Criminal", "Noble", "Hermit", "Outlander", "Entertainer", "Artisan", "Sailor", "Soldier", "Charlatan", "Knight", "Pirate", "Spy", "Archaeologist", "Gladiator", "Inheritor", "Haunted One", "Bounty Hunter", "Explorer", "Watcher", "Traveler", "Phantom", "Vigilante"]
-genders = ["Male", "Female", "Non-binary"]
-image_styles = ["Standard", "8bit Style", "Anime Style"]
-themes = ["Fantasy / Medieval", "Steampunk", "Post-Apocalyptic","Cyberpunk","Dark Fantasy","Sci-Fi"]
-
-# Generation functions
-def generate_character(name, gender, race, character_class, background):
-    return {"Name": name, "Gender": gender, "Race": race, "Class": character_class, "Background": background}
-
-def generate_character_history(character, theme=None, generate_history=True):
-    if not generate_history:
-        return ""
-
-    # Only modify prompt if a theme was selected
-    theme_text = f" The story should fit within a {theme} setting." if theme and "Default" not in theme else ""
-
-    prompt = (
-        f"Create a short backstory for a {character['Race']} {character['Class']} named {character['Name']}."
-        f" They come from a {character['Background']} background.{theme_text}"
-    )
-
-    response = openai.ChatCompletion.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "You are a creative storyteller who writes lore for video game worlds."},
-            {"role": "user", "content": prompt}
-        ]
-    )
-
-    return response["choices"][0]["message"]["content"]
-# World Builder Functions
-
-def generate_npc_names(count=10):
-    prompt = f"Generate {count} unique fantasy NPC names along with their roles and a brief background for each. Include some variety, like merchants, warriors, scholars, and mystics."
-    response = openai.ChatCompletion.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}]
-    )
-    lines = response["choices"][0]["message"]["content"].strip().split("\n")
-    npcs = []
-    for line in lines:
-        if ": " in line:
-            name, details = line.split(": ", 1)
-            role, background = details.split(". ", 1)
-            npcs.append({"name": name.strip(), "role": role.strip(), "backstory": background.strip()})
-    return npcs
-
-def generate_location_names(count=10):
-    prompt = f"Generate {count} unique fantasy location names with a short description for each. Include different types of places like towns, ancient ruins, mystical forests, and mountain strongholds."
-    response = openai.ChatCompletion.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}]
-    )
-    lines = response["choices"][0]["message"]["content"].strip().split("\n")
-    locations = []
-    for line in lines:
-        if ": " in line:
-            name, description = line.split(": ", 1)
-            locations.append({"name": name.strip(), "description": description.strip()})
-    return locations
-
-
-def initialize_world(world_name):
-    world = {"name": world_name, "regions": {}}
-    for i in range(5):
-        for j in range(5):
-            world["regions"][f"{i+1}-{j+1}"] = {"name": f"Location {i+1}-{j+1}", "characters": [], "npcs": [], "quests": [], "capital": False, "special_traits": []}
-    st.session_state.worlds.append(world)
-    return world
-
-def add_to_region(world_name, region_key, entry_type, entry):
-    for world in st.session_state.worlds:
-        if world["name"] == world_name:
-            world["regions"][region_key][entry_type].append(entry)
-
-
-def save_journal(world_name, journal_text):
-    filename = f"journal_{world_name}.txt"
-    with open(filename, "w", encoding="utf-8") as file:
-        file.write(journal_text)
-
-def load_journal(world_name):
-    filename = f"journal_{world_name}.txt"
-    if os.path.exists(filename):
-        with open(filename, "r", encoding="utf-8") as file:
-            return file.read()
-    return ""
-    
-def create_journal_pdf(journal_text, characters):
-    buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=letter)
-    x, y = 50, 750
-    line_height = 12
-    max_width = 500
-
-    def section(title, content):
-        nonlocal y
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(x, y, title)
-        y -= line_height
-        c.setFont("Helvetica", 8)
-        for line in simpleSplit(content, "Helvetica", 8, max_width):
-            c.drawString(x, y, line)
-            y -= line_height
-        y -= line_height
-
-    # Journal text
-    section("World Journal", journal_text)
-
-    # Images of characters
-    for ch in characters:
-        c.setFont("Helvetica-Bold", 9)
-        c.drawString(x, y, f"Character: {ch['character']['Name']}")
-        y -= line_height
-        for url in ch["images"]:
-            img = download_image(url)
-            if img:
-                if y - 300 < 0:
-                    c.showPage()
-                    y = 750
-                c.drawImage(img, x, y - 250, width=250, height=250, preserveAspectRatio=True)
-                y -= 270
-        y -= line_height
-
-    c.showPage()
-    c.save()
-    buffer.seek(0)
-    return buffer
-    
-def generate_world_journal(world):
-    journal_entries = []
-    for region_key, region in world["regions"].items():
-        entry = f"**{region['name']}**\n"
-        
-        # Include capital city info
-        if region["capital"]:
-            entry += "Capital Region\n"
-        
-        # Add special traits or lore to the region
-        if region["special_traits"]:
-            entry += "Special Traits:\n" + "\n".join([f"- {trait}" for trait in region["special_traits"]]) + "\n"
-        
-        # Add characters info
-        if region["characters"]:
-            entry += "Characters:\n" + "\n".join([f"- {c['Name']} ({c['Race']} {c['Class']}) - Last Seen: {c.get('last_action', 'Unknown')}" for c in region["characters"]]) + "\n"
-        
-        # Add NPC info
-        if region["npcs"]:
-            entry += "NPCs:\n" + "\n".join([f"- {npc['name']} ({npc['role']}) - Last Seen: {npc.get('last_action', 'Unknown')}" for npc in region["npcs"]]) + "\n"
-        
-        # Add quests info
-        if region["quests"]:
-            entry += "Quests:\n" + "\n".join([f"- {quest['title']} - Last Update: {quest.get('last_action', 'Unknown')}" for quest in region["quests"]]) + "\n"
-        
-        # Use AI to generate regional content based on stories, characters, and quests
-        if region["characters"] or region["quests"]:
-            prompt = f"Generate a fantasy description of the region '{region['name']}' using the following elements:\n"
-            prompt += "Characters:\n" + "\n".join([f"- {c['Name']} ({c['Race']} {c['Class']})" for c in region["characters"]]) + "\n" if region["characters"] else ""
-            prompt += "NPCs:\n" + "\n".join([f"- {npc['name']} ({npc['role']})" for npc in region["npcs"]]) + "\n" if region["npcs"] else ""
-            prompt += "Quests:\n" + "\n".join([f"- {quest['title']}: {quest['description']}" for quest in region["quests"]]) + "\n" if region["quests"] else ""
-            prompt += f"Generate a rich, detailed story or lore for this region based on these elements, adding mystery, drama, or historical context.\n"
-            
-            # Get a response from the AI to enrich the region with lore and details
-            response = openai.ChatCompletion.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "system", "content": "You are a fantasy world-building assistant."},
-                          {"role": "user", "content": prompt}]
-            )
-            entry += f"Lore/Story:\n{response['choices'][0]['message']['content']}\n"
-        
-        journal_entries.append(entry)
-    
-    return "\n\n".join(journal_entries)
-
-
-def generate_story(character, npc, quest):
-    prompt = (
-        f"Write a short D&D style story paragraph involving the following quest, party, and NPC:\n"
-        f"Character: {character['Name']} ({character['Race']} {character['Class']}, {character['Background']})\n"
-        f"NPC: {npc['name']} - {npc['role']}, {npc['backstory']}\n"
-        f"Make it immersive and written like George RR Martin recounting an adventure."
-    )
-    response = openai.ChatCompletion.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "system", "content": "You are a fantasy storyteller."}, {"role": "user", "content": prompt}]
-    )
-    return response['choices'][0]['message']['content']
-
-def generate_character_image(character, style="Standard", theme=None):
-    theme_text = f"in a {theme} world, " if theme and "Default" not in theme else ""
-    
-    base_prompt = (
-        f"A full-body portrait of a {character['Gender']} {character['Race']} {character['Class']}, "
-        f"{theme_text}wearing detailed clothing that matches their background. "
-        f"High-quality concept art, consistent lighting, dynamic pose."
-    )
-
-    # Keep your existing style logic
-    if style == "8bit Style": base_prompt += " Pixel art, 8-bit sprite."
-    elif style == "Anime Style": base_prompt += " Anime cel-shaded style."
-    elif style == "Realistic Style": base_prompt += " Realistic fantasy rendering."
-
-    response = openai.Image.create(model="dall-e-3", prompt=base_prompt, size="1024x1024")
-    return response["data"][0]["url"]
-
-def generate_npc(generate_npc_text=True):
-    if generate_npc_text:
-        prompt = "Generate a unique fantasy NPC name and their profession."
-        response = openai.ChatCompletion.create(model="gpt-4o-mini", messages=[{"role": "user", "content": prompt}])
-        content = response["choices"][0]["message"]["content"].strip()
-        if ", " in content:
-            name, role = content.split(", ", 1)
-        else:
-            name, role = content, random.choice(["merchant", "guard", "wizard", "priest"])
-        backstory = f"{name} is a {role} with a mysterious past."
-    else:
-        name, role, backstory = "Unknown", "Unknown", "No backstory provided."
-    return {"name": name, "role": role, "backstory": backstory}
-
-
-def generate_quest(generate_quest_text=True):
-    if generate_quest_text:
-        prompt = "Create a fantasy quest with a title and short description."
-        response = openai.ChatCompletion.create(model="gpt-4o-mini", messages=[{"role": "user", "content": prompt}])
-        parts = response["choices"][0]["message"]["content"].strip().split("\n", 1)
-        title = parts[0]
-        description = parts[1] if len(parts) > 1 else "A mysterious quest awaits."
-    else:
-        title, description = "Untitled Quest", "No description provided."
-    return {"title": title, "description": description}
-
-def download_image(image_url):
-    try:
-        response = requests.get(image_url)
-        return ImageReader(BytesIO(response.content))
-    except:
-        return None
-
-def draw_wrapped_text(canvas, text, x, y, max_width, line_height):
-    from reportlab.pdfbase.pdfmetrics import stringWidth
-    words = text.split()
-    line = ""
-    for word in words:
-        test_line = f"{line} {word}".strip()
-        if stringWidth(test_line, "Helvetica", 7) > max_width:
-            canvas.drawString(x, y, line)
-            y -= line_height
-            line = word
-        else:
-            line = test_line
-    if line:
-        canvas.drawString(x, y, line)
-        y -= line_height
-    return y
-
-def create_pdf(character, npc, quest, images):
-    buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=letter)
-    x, y = 50, 750
-    line_height = 12; max_width = 500
-    def section(title, content):
-        nonlocal y
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(x, y, title)
-        y -= line_height
-        c.setFont("Helvetica", 8)
-        y = draw_wrapped_text(c, content, x, y, max_width, line_height)
-        y -= line_height
-    section("Character Info", f"{character['Name']} ({character['Gender']}, {character['Race']}, {character['Class']})")
-    section("Background", character['Background'])
-    section("History", character.get('History', ''))
-    section("NPC", f"{npc['name']} - {npc['role']}")
-    section("NPC Backstory", npc['backstory'])
-    section("Quest", quest['title'])
-    section("Quest Description", quest['description'])
-    for url in images:
-        img = download_image(url)
-        if img:
-            if y - 270 < 0: c.showPage(); y = 750
-            c.drawImage(img, x, y - 400, width=400, height=400, preserveAspectRatio=True)
-            y -= 420
-    c.showPage(); c.save(); buffer.seek(0)
-    return buffer
-
-def save_to_json(character, npc, quest, file_name="character_data.json"):
-    with open(file_name, 'w') as f:
-        json.dump({"character": character, "npc": npc, "quest": quest}, f, indent=4)
-        
+for key in ("characters", "parties", "stories", "journals", "regions"):
+    st.session_state.setdefault(key, [])
+# Worlds are keyed by name so region updates find their world directly
+st.session_state.setdefault("worlds", {})
+# One generator per session, so sessions never share or reseed the global random state
+rng = st.session_state.setdefault("rng", random.Random())
+
+# Characters drawn per page in Character mode; each one builds a set of tabs and a PDF
+CHARACTERS_PER_PAGE = 5
+
 # --- MAIN UI ---
 st.title("🎭 Mana Forge Character Generator & Toolkit", anchor="title")
-mode = st.sidebar.radio("Select Mode:", ["Character", "World Builder"])
+mode = st.sidebar.radio("Select Mode:", ["Character", "World Builder"], key="mode")
 
 
 # Character mode
 if mode == "Character":
-    name = st.text_input("Enter character name:")
-    selected_race = st.selectbox("Select race:", races)
-    selected_gender = st.selectbox("Select gender:", genders)
-    auto_generate = st.checkbox("Auto-generate class & background?", value=True)
-
-    selected_style = st.selectbox("Select Art Style:", image_styles)
-    selected_theme = st.selectbox("Select World Theme (optional):", themes, index=0)
-    generate_music = st.checkbox("Generate Theme Song (Audiocraft)")
-    generate_turnaround = st.checkbox("Generate 360° Turnaround")
-    generate_location = st.checkbox("Generate Place of Origin")
-    generate_extra = st.checkbox("Generate Extra Images")
-    generate_history = st.checkbox("Generate Character History")
-    generate_npc_text = st.checkbox("Generate NPC Text")
-    generate_quest_text = st.checkbox("Generate Quest Text")
+    name = st.text_input("Enter character name:", key="name_input")
+    selected_race = st.selectbox("Select race:", races, key="race_select")
+    selected_gender = st.selectbox("Select gender:", genders, key="gender_select")
+    auto_generate = st.checkbox("Auto-generate class & background?", value=True, key="auto_generate")
+
+    selected_style = st.selectbox("Select Art Style:", image_styles, key="style_select")
+    selected_quality = st.selectbox("Portrait Quality:", list(portrait_qualities), key="quality_select")
+    selected_theme = st.selectbox("Select World Theme (optional):", themes, index=0, key="theme_select")
+    generate_music = st.checkbox("Generate Theme Song (Audiocraft)", key="generate_music")
+    generate_turnaround = st.checkbox("Generate 360° Turnaround", key="generate_turnaround")
+    generate_location = st.checkbox("Generate Place of Origin", key="generate_location")
+    generate_extra = st.checkbox("Generate Extra Images", key="generate_extra")
+    generate_history = st.checkbox("Generate Character History", key="generate_history")
+    generate_npc_text = st.checkbox("Generate NPC Text", key="generate_npc_text")
+    generate_quest_text = st.checkbox("Generate Quest Text", key="generate_quest_text")
+    batch_mode = st.checkbox("Batch mode (text at half price, ready within 24h)", key="batch_mode")
+    fast_mode = st.checkbox("Fast mode (no LLM for NPC/quest)", key="fast_mode")
+    regenerate = st.checkbox("Regenerate (skip cached history and images)", key="regenerate")
 
     if not auto_generate:
-        character_class = st.selectbox("Select class:", classes)
-        background = st.selectbox("Select background:", backgrounds)
+        character_class = st.selectbox("Select class:", classes, key="class_select")
+        background = st.selectbox("Select background:", backgrounds, key="background_select")
+
+    theme_to_use = None if selected_theme == "Fantasy / Medieval" else selected_theme
 
     if st.button("Generate Character"):
         if not name.strip():
@@ -350,30 +67,71 @@ if mode == "Character":
         else:
             # Handle auto-generation inside the button press
             if auto_generate:
-                character_class = random.choice(classes)
-                background = random.choice(backgrounds)
+                character_class = rng.choice(classes)
+                background = rng.choice(backgrounds)
 
             char = generate_character(name, selected_gender, selected_race, character_class, background)
-            theme_to_use = None if selected_theme == "Fantasy / Medieval" else selected_theme
             
-            char["History"] = generate_character_history(char, theme=theme_to_use, generate_history=generate_history)
-            image_urls = [generate_character_image(char, selected_style, theme=theme_to_use)]
-
-            if generate_turnaround: image_urls.append(generate_character_image(char, selected_style))
-            if generate_location: image_urls.append(generate_character_image(char, selected_style))
-            if generate_extra:
-                image_urls.append(generate_character_image(char, selected_style))
-                image_urls.append(generate_character_image(char, selected_style))
-            npc = generate_npc(generate_npc_text)
-            quest = generate_quest(generate_quest_text)
-            st.session_state.characters.append({"character": char, "npc": npc, "quest": quest, "images": image_urls})
+            variants = ["turnaround"] * generate_turnaround + ["location"] * generate_location + ["extra_1", "extra_2"] * generate_extra
+            if regenerate:
+                forget_character_images(char, selected_style, theme_to_use, selected_quality, variants)
+            # NPC, quest and images are fetched in the background while the backstory streams in
+            # In batch mode only the images are made now; the text is queued for the next batch
+            live_text = not batch_mode
+            # Fast mode fills the NPC and quest from local templates instead of the model
+            npc_from_model, quest_from_model = generate_npc_text and not fast_mode, generate_quest_text and not fast_mode
+            bundle = run_in_background(run_async, build_character_bundle(
+                char, selected_style, selected_quality, theme_to_use, variants, npc_from_model and live_text, quest_from_model and live_text
+            ))
+            song = run_in_background(generate_theme_song, char, theme_to_use, pool="music") if generate_music else None
+            char["History"] = st.write_stream(stream_character_history(char, theme_to_use, regenerate)) if generate_history and live_text else ""
+            (npc, quest, images), = bundle.result()
+            if fast_mode:
+                npc = template_npc(rng) if generate_npc_text else npc
+                quest = template_quest(rng) if generate_quest_text else quest
+            data = {"character": char, "npc": npc, "quest": quest, "images": images}
+            if song:
+                data["song"] = song.result()
+            if batch_mode:
+                data["pending"] = character_text_requests(char, theme_to_use, generate_history, npc_from_model, quest_from_model)
+            st.session_state.characters.append(data)
             st.success(f"Character '{char['Name']}' Created!")
 
-    for i, data in enumerate(st.session_state.characters):
+    # Characters made before music was switched on get their songs from one batched MusicGen call.
+    # It queues on the music pool, so only one song job holds the model at a time.
+    songless = [d for d in st.session_state.characters if "song" not in d]
+    if generate_music and songless and st.button(f"Generate theme songs ({len(songless)} characters)"):
+        songs = run_in_background(generate_theme_songs, [d["character"] for d in songless], theme_to_use, pool="music").result()
+        for data, song in zip(songless, songs):
+            data["song"] = song
+        st.success(f"{len(songs)} theme songs added.")
+
+    pending = sum(bool(d.get("pending")) for d in st.session_state.characters)
+    if pending and st.button(f"Submit batch ({pending} characters)"):
+        submit_character_batch(st.session_state.characters)
+        st.success("Batch submitted. Use 'Check batch' to collect the text once it is ready.")
+    if st.session_state.get("character_batches") and st.button("Check batch"):
+        collected, errors = check_character_batches(st.session_state.characters)
+        for error in errors:
+            st.error(error)
+        if collected:
+            st.success("Batch results added to your characters.")
+        elif not errors:
+            st.info("Batch still running, check back later.")
+
+    # Only one page of characters is drawn, so a long roster does not slow every rerun
+    characters = st.session_state.characters
+    page_count = max(1, -(-len(characters) // CHARACTERS_PER_PAGE))
+    page = st.number_input("Page", min_value=1, max_value=page_count, key="character_page") if page_count > 1 else 1
+    shown = characters[(page - 1) * CHARACTERS_PER_PAGE:page * CHARACTERS_PER_PAGE]
+
+    for data in shown:
         ch, npc, quest, imgs = data['character'], data['npc'], data['quest'], data['images']
         tabs = st.tabs(["Info", "History", "NPC", "Quests", "Images", "Export"])
         with tabs[0]:
             st.write(f"**{ch['Name']}** — {ch['Gender']}, {ch['Race']} {ch['Class']} ({ch['Background']})")
+            if data.get("song"):
+                st.audio(data["song"], format="audio/wav")
         with tabs[1]:
             st.write(ch.get('History', 'No history generated'))
         with tabs[2]:
@@ -383,12 +141,12 @@ if mode == "Character":
             st.write(f"**{quest['title']}**")
             st.write(quest['description'])
         with tabs[4]:
-            for url in imgs:
-                st.image(url, use_container_width=True)
+            for variant, image in imgs.items():
+                st.image(image, caption=variant.replace("_", " ").title(), use_container_width=True)
         with tabs[5]:
-            st.download_button("Download JSON", data=json.dumps({"character": ch, "npc": npc, "quest": quest}), file_name=f"{ch['Name']}.json")
-            pdf_buf = create_pdf(ch, npc, quest, imgs)
-            st.download_button("Download PDF", data=pdf_buf, file_name=f"{ch['Name']}.pdf", mime="application/pdf")
+            st.download_button("Download JSON", data=orjson.dumps({"character": ch, "npc": npc, "quest": quest}, option=orjson.OPT_INDENT_2), file_name=f"{ch['Name']}.json")
+            # PDFs are passed as callables so they are only laid out when the button is clicked
+            st.download_button("Download PDF", data=partial(create_pdf, ch, npc, quest, imgs), file_name=f"{ch['Name']}.pdf", mime="application/pdf")
 
 # --- WORLD BUILDER ---
 if mode == "World Builder":
@@ -400,31 +158,22 @@ if mode == "World Builder":
         if not st.session_state.characters:
             st.warning("Create at least 1 character to form a party.")
         else:
-            options = [f"{i+1}. {d['character']['Name']}" for i, d in enumerate(st.session_state.characters)]
-            selected = st.multiselect("Select party members:", options)
+            # Options are character indices, so the selection needs no lookup back from its labels
+            characters = st.session_state.characters
+            selected = st.multiselect("Select party members:", range(len(characters)), format_func=lambda i: f"{i+1}. {characters[i]['character']['Name']}")
 
             if st.button("Generate / Continue Party Story") and selected:
-                idxs = [options.index(s) for s in selected]
-                members = [st.session_state.characters[i] for i in idxs]
-                names = ", ".join([m['character']['Name'] for m in members])
-
-                # Check if party exists
-                existing_party = None
-                for party in st.session_state.parties:
-                    party_names = [m['character']['Name'] for m in party['members']]
-                    if set(names.split(", ")) == set(party_names):
-                        existing_party = party
-                        break
-
-                # Prepare prompt with existing story
-                existing_story = existing_party['story'] if existing_party else ""
-                prompt = f"Continue the story for party members: {names}.\n\n{existing_story}"
-
-                response = openai.ChatCompletion.create(
-                    model="gpt-4o-mini",
-                    messages=[{"role": "user", "content": prompt}]
-                )
-                story_text = response['choices'][0]['message']['content']
+                members = [characters[i] for i in selected]
+
+                # Check if party exists: same members in any order
+                member_names = frozenset(m['character']['Name'] for m in members)
+                existing_party = next((party for party in st.session_state.parties
+                                       if frozenset(m['character']['Name'] for m in party['members']) == member_names), None)
+
+                # An existing party keeps its own member order, so the continuation matches the story cache
+                party_members = existing_party['members'] if existing_party else members
+                story_text = st.write_stream(stream_party_story([m['character']['Name'] for m in party_members],
+                                                                existing_party['story'] if existing_party else ""))
 
                 # Update or create party
                 if existing_party:
@@ -434,119 +183,207 @@ if mode == "World Builder":
 
                 st.success("Story generated and appended!")
 
+            # Every party's next chapter in one go, with the requests running side by side
+            if len(st.session_state.parties) > 1 and st.button("Continue All Party Stories"):
+                parties = st.session_state.parties
+                chapters = continue_party_stories([([m['character']['Name'] for m in p['members']], p['story']) for p in parties])
+                for party, chapter in zip(parties, chapters):
+                    party['story'] += "\n\n" + chapter
+                st.success(f"{len(parties)} party stories continued!")
+
             # Display all party stories
             for idx, party in enumerate(st.session_state.parties):
                 exp = st.expander(f"Party {idx+1}: {', '.join([m['character']['Name'] for m in party['members']])}", expanded=True)
-                with exp:
-                    st.text_area("Story", value=party['story'], height=200)
+                # Edits are applied on save only, so typing does not rerun the whole page
+                with exp, st.form(f"party_story_{idx}"):
+                    edited_story = st.text_area("Story", value=party['story'], height=200)
+                    if st.form_submit_button("Save Story"):
+                        party['story'] = edited_story
     # --- JOURNAL TAB ---
     with tab2:
         st.header("📓 World Journal")
+
+        # Place characters on a world's 5x5 grid; the regions' lore is written into the journal
+        with st.expander("🗺️ World Grid"):
+            col_name, col_create = st.columns([3, 1])
+            world_name = col_name.text_input("World name", key="world_name")
+            if col_create.button("Create World") and world_name:
+                initialize_world(world_name)
+            worlds = st.session_state.worlds
+            if worlds:
+                world = worlds[st.selectbox("World", list(worlds), key="world_choice")]
+                if st.session_state.characters:
+                    col_char, col_region, col_place = st.columns([2, 1, 1])
+                    names = [ch['character']['Name'] for ch in st.session_state.characters]
+                    char_idx = col_char.selectbox("Character", range(len(names)), format_func=names.__getitem__, key="world_character")
+                    region_key = col_region.selectbox("Region", list(world["regions"]), key="world_region")
+                    if col_place.button("Place in Region"):
+                        # The character brings their NPC and quest along
+                        ch = st.session_state.characters[char_idx]
+                        for entry_type, entry in (("characters", ch['character']), ("npcs", ch['npc']), ("quests", ch['quest'])):
+                            add_to_region(world["name"], region_key, entry_type, entry)
+                        st.success(f"{names[char_idx]} placed in {world['regions'][region_key]['name']}.")
+                col_live, col_batch, col_check = st.columns(3)
+                if col_live.button("Write World Lore"):
+                    for w, world_journal in zip(worlds.values(), generate_world_journals(list(worlds.values()))):
+                        w["journal"] = world_journal
+                # Or queue this world's lore through the Batch API at half price
+                if col_batch.button("Queue Lore Batch"):
+                    if submit_lore_batch(world):
+                        st.success("Lore batch queued. Results are ready within 24h.")
+                    else:
+                        st.info("No regions are waiting for lore.")
+                if world["name"] in st.session_state.get("lore_batches", {}) and col_check.button("Check Lore Batch"):
+                    errors = check_lore_batch(world)
+                    if errors is None:
+                        st.info("Batch still running, check back later.")
+                    elif errors:
+                        # Lore the batch did write is cached; Write World Lore covers the rest
+                        for error in errors:
+                            st.error(error)
+                    else:
+                        # The batch's lore is cached under the prompts it was written for, so the rebuild
+                        # only requests regions whose contents changed since the batch was queued
+                        world["journal"], = generate_world_journals([world])
+                        st.success("World lore added to the journal.")
     
-        # Build journal dynamically
-        journal_entries = []
+        # Rebuild the journal only when the text it is built from changed, or on request. The key hashes
+        # that text itself, so batch results and same-length edits are picked up too.
+        if st.button("Refresh Journal"):
+            st.session_state.pop("journal_key", None)
+        journal_key = hashlib.sha256(orjson.dumps([
+            [[ch['character'], ch.get('npc')] for ch in st.session_state.characters],
+            [[[m['character']['Name'] for m in p['members']], p['story']] for p in st.session_state.parties],
+            [r.get("description") for r in st.session_state.regions],
+            [[w["name"], w.get("journal", "")] for w in st.session_state.worlds.values()],
+        ])).hexdigest()
+        if st.session_state.get("journal_key") != journal_key:
+            journal_entries = []
     
-        # Characters
-        if st.session_state.characters:
-            journal_entries.append("**Characters:**")
-            for ch in st.session_state.characters:
-                c = ch['character']
-                journal_entries.append(f"- {c['Name']} ({c['Race']} {c['Class']}) Background: {c['Background']}")
+            # Characters
+            if st.session_state.characters:
+                journal_entries.append("**Characters:**")
+                for ch in st.session_state.characters:
+                    c = ch['character']
+                    journal_entries.append(f"- {c['Name']} ({c['Race']} {c['Class']}) Background: {c['Background']}")
                 
-                # Add associated NPCs for this character
-                npc = ch.get('npc')
-                if npc:
-                    journal_entries.append(f"  - NPC: {npc['name']} ({npc['role']}) - {npc.get('backstory','No backstory')}")
+                    # Add associated NPCs for this character
+                    npc = ch.get('npc')
+                    if npc:
+                        journal_entries.append(f"  - NPC: {npc['name']} ({npc['role']}) - {npc.get('backstory','No backstory')}")
     
-        # Party Stories
-        if st.session_state.parties:
-            journal_entries.append("\n**Party Stories:**")
-            for idx, party in enumerate(st.session_state.parties):
-                journal_entries.append(f"\nParty {idx+1}: {', '.join([m['character']['Name'] for m in party['members']])}")
-                journal_entries.append(party['story'])
+            # Party Stories
+            if st.session_state.parties:
+                journal_entries.append("\n**Party Stories:**")
+                for idx, party in enumerate(st.session_state.parties):
+                    journal_entries.append(f"\nParty {idx+1}: {', '.join([m['character']['Name'] for m in party['members']])}")
+                    journal_entries.append(party['story'])
     
-        # Optionally, include global or region NPCs if you have st.session_state.regions
-        if "regions" in st.session_state and st.session_state.regions:
-            journal_entries.append("\n**Region NPCs:**")
-            for region in st.session_state.regions:
-                desc = region.get("description", {})
-                npcs = desc.get("npcs", []) if isinstance(desc, dict) else []
-                for npc in npcs:
-                    if isinstance(npc, dict):
-                        journal_entries.append(f"- {npc.get('name','Unknown')} ({npc.get('role','Unknown')}): {npc.get('description','')}")
-                    else:
-                        journal_entries.append(f"- {npc}")
+            # Optionally, include global or region NPCs if you have st.session_state.regions
+            if "regions" in st.session_state and st.session_state.regions:
+                journal_entries.append("\n**Region NPCs:**")
+                for region in st.session_state.regions:
+                    desc = region.get("description", {})
+                    npcs = desc.get("npcs", []) if isinstance(desc, dict) else []
+                    for npc in npcs:
+                        if isinstance(npc, dict):
+                            journal_entries.append(f"- {npc.get('name','Unknown')} ({npc.get('role','Unknown')}): {npc.get('description','')}")
+                        else:
+                            journal_entries.append(f"- {npc}")
+
+            # Lore written for the world grids
+            for world in st.session_state.worlds.values():
+                if world.get("journal"):
+                    journal_entries.append(f"\n**World: {world['name']}**")
+                    journal_entries.append(world["journal"])
     
-        # Store journal in session state
-        st.session_state.journal_text = "\n".join(journal_entries)
-        journal_text = st.text_area("World Journal", value=st.session_state.journal_text, height=400)
+            st.session_state.journal_text = st.session_state.journal_editor = "\n".join(journal_entries)
+            st.session_state.journal_key = journal_key
+        # Keyed so edits reach Save and the downloads straight away; the widget state is dropped
+        # while World Builder is not shown, so it is restored from journal_text
+        st.session_state.setdefault("journal_editor", st.session_state.journal_text)
+        journal_text = st.session_state.journal_text = st.text_area("World Journal", key="journal_editor", height=400)
     
         # Show all character images here
         if st.session_state.characters:
             st.subheader("Character Images")
             for ch in st.session_state.characters:
                 st.markdown(f"**{ch['character']['Name']}**")
-                for url in ch['images']:
-                    st.image(url, use_container_width=True)
+                for variant, image in ch['images'].items():
+                    st.image(image, caption=variant.replace("_", " ").title(), use_container_width=True)
     
         # Save / Export
         col1, col2, col3 = st.columns([1,1,1])
         with col1:
             if st.button("Save Journal"):
-                save_journal("world", journal_text)
-                st.session_state.journal_text = journal_text
-                st.success("Journal saved!")
+                try:
+                    save_journal("world", journal_text)
+                except OSError as e:
+                    st.error(f"Could not save journal: {e}")
+                else:
+                    st.success("Journal saved!")
         with col2:
             st.download_button("Download Journal (TXT)", data=journal_text, file_name="world_journal.txt", mime="text/plain")
         with col3:
-            pdf_buf = create_journal_pdf(journal_text, st.session_state.characters)
-            st.download_button("Download Journal (PDF)", data=pdf_buf, file_name="world_journal.pdf", mime="application/pdf")
+            st.download_button("Download Journal (PDF)", data=partial(create_journal_pdf, journal_text, st.session_state.characters), file_name="world_journal.pdf", mime="application/pdf")
 
 
     # --- REGIONS TAB ---
     with tab3:
         st.header("🌍 AI-Generated Regions")
+
+        # Bulk NPC and location names go through the Batch API at half price
+        col_queue, col_check = st.columns(2)
+        with col_queue:
+            if st.button("Queue NPC & Location Batch"):
+                submit_names_batch()
+                st.success("Batch queued. Results are ready within 24h.")
+        with col_check:
+            if st.session_state.get("names_batch") and st.button("Check NPC & Location Batch"):
+                errors = check_names_batch()
+                if errors is None:
+                    st.info("Batch still running, check back later.")
+                elif errors:
+                    for error in errors:
+                        st.error(error)
+                else:
+                    st.success("NPCs and locations added.")
+        if st.session_state.get("npcs") or st.session_state.get("locations"):
+            with st.expander("Generated NPCs & Locations"):
+                st.json({"npcs": st.session_state.get("npcs", []), "locations": st.session_state.get("locations", [])})
     
         if "regions" not in st.session_state:
             st.session_state.regions = []
     
-        def extract_json_from_text(text):
-            import re
-            try:
-                match = re.search(r'\{.*\}', text, flags=re.DOTALL)
-                if match:
-                    return json.loads(match.group())
-            except json.JSONDecodeError:
-                pass
-            return None
-    
         if st.button("Create New Region from Journal"):
             journal_text = st.session_state.journal_text
-            all_npcs = [ch['npc'] for ch in st.session_state.characters]
-            all_quests = [ch['quest'] for ch in st.session_state.characters]
-            party_stories = "\n\n".join([p['story'] for p in st.session_state.parties])
+            existing_regions = [r['name'] for r in st.session_state.regions]
+            # NPCs, quests, party stories and regions only grow between clicks, so they go first as one
+            # compact message that repeats byte-for-byte as a cacheable prefix; the edited journal comes last
+            shared_context = orjson.dumps({
+                "npcs": [ch['npc'] for ch in st.session_state.characters],
+                "quests": [ch['quest'] for ch in st.session_state.characters],
+                "party_stories": [p['story'] for p in st.session_state.parties],
+                "existing_regions": existing_regions,
+            }).decode("utf-8")
+            # The prompt is built from the session's content and lists the regions made so far, so a
+            # repeat only happens for identical worlds and each click still yields a new region.
+            # The journal is free text, so near-identical worlds are matched semantically as well, but only
+            # against worlds with the same regions, so a match can never hand back a region already made.
+            content = cached_chat(
+                model="gpt-4o-mini", semantic=f"region|{hashlib.sha256(orjson.dumps(existing_regions)).hexdigest()}",
+                messages=[{"role": "system", "content": SYS_REGION},
+                          {"role": "user", "content": shared_context},
+                          {"role": "user", "content": f"World Journal:\n{journal_text}"}],
+                response_format={"type": "json_object"}
+            ).strip()
     
-            prompt = (
-                f"Using the following world journal, NPCs, quests, and party stories, generate a unique fantasy region. "
-                f"Return a JSON object with 'name' and 'description'. The 'description' itself should be a JSON object "
-                f"with keys: 'terrain', 'climate', 'special_features', 'quests', 'npcs'. ONLY RETURN JSON.\n\n"
-                f"World Journal:\n{journal_text}\n\n"
-                f"NPCs:\n{json.dumps(all_npcs, indent=2)}\n\n"
-                f"Quests:\n{json.dumps(all_quests, indent=2)}\n\n"
-                f"Party Stories:\n{party_stories}"
-            )
-            response = openai.ChatCompletion.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}]
-            )
-            content = response['choices'][0]['message']['content'].strip()
-    
-            # Extract JSON safely
-            region_data = extract_json_from_text(content)
-            if region_data:
+            # JSON mode always returns an object; only a reply cut off at the token limit fails to parse
+            try:
+                region_data = orjson.loads(content)
                 region_name = region_data.get("name", "Unknown Region")
                 region_description = region_data.get("description", {})
-            else:
+            except orjson.JSONDecodeError:
                 region_name = "Unknown Region"
                 region_description = content
     
@@ -620,7 +457,7 @@ if len(st.session_state.regions) > 5:
                     st.json(d)
     
             # Export Macro-Region JSON
-            macro_json = json.dumps(st.session_state.macro_region, indent=2, ensure_ascii=False)
+            macro_json = orjson.dumps(st.session_state.macro_region, option=orjson.OPT_INDENT_2)
             st.download_button(
                 "📥 Download Macro-Region JSON",
                 data=macro_json,
@@ -632,7 +469,6 @@ if len(st.session_state.regions) > 5:
             def create_macro_pdf(macro_region):
                 from reportlab.pdfgen import canvas
                 from reportlab.lib.pagesizes import letter
-                from reportlab.lib.utils import simpleSplit
                 buffer = BytesIO()
                 c = canvas.Canvas(buffer, pagesize=letter)
                 width, height = letter
@@ -643,7 +479,7 @@ if len(st.session_state.regions) > 5:
                 c.setFont("Helvetica", 10)
     
                 def draw_text(text, x, y, max_width):
-                    lines = simpleSplit(text, "Helvetica", 10, max_width)
+                    lines = wrap_text(text, max_width, 10)
                     for line in lines:
                         c.drawString(x, y, line)
                         y -= 12
@@ -662,19 +498,17 @@ if len(st.session_state.regions) > 5:
                         y = draw_text(desc_json, x + 20, y, width - 120)
     
                 c.save()
-                buffer.seek(0)
-                return buffer
+                return buffer.getvalue()
     
-            pdf_buffer = create_macro_pdf(st.session_state["macro_region"])
             st.download_button(
                 "📖 Download Macro-Region PDF",
-                data=pdf_buffer,
+                data=partial(create_macro_pdf, st.session_state["macro_region"]),
                 file_name="macro_region.pdf",
                 mime="application/pdf"
             )
         # 🔽 DOWNLOAD ALL REGIONS
         if st.session_state.regions:
-            regions_json = json.dumps(st.session_state.regions, indent=2, ensure_ascii=False)
+            regions_json = orjson.dumps(st.session_state.regions, option=orjson.OPT_INDENT_2)
             regions_txt = "\n\n".join(
                 [f"{r['name']}\n{r['description']}" if isinstance(r['description'], str)
                  else f"{r['name']}\nTerrain: {r['description'].get('terrain','N/A')}\nClimate: {r['description'].get('climate','N/A')}"
@@ -0,0 +1,30 @@
+# Character traits
+races = ("Human", "Elf", "Dwarf", "Halfling", "Gnome", "Half-Orc", "Tiefling", "Dragonborn", "Kobold", "Lizardfolk", "Minotaur", "Troll", "Vampire", "Satyr", "Undead", "Lich", "Werewolf")
+classes = ("Fighter", "Wizard", "Rogue", "Cleric", "Barbarian", "Sorcerer", "Bard", "Monk", "Druid", "Ranger", "Paladin", "Warlock", "Artificer", "Blood Hunter", "Mystic", "Warden", "Berserker", "Necromancer", "Trickster", "Beast Master", "Alchemist", "Pyromancer", "Dark Knight")
+backgrounds = ("Acolyte", "Folk Hero", "Sage", "Criminal", "Noble", "Hermit", "Outlander", "Entertainer", "Artisan", "Sailor", "Soldier", "Charlatan", "Knight", "Pirate", "Spy", "Archaeologist", "Gladiator", "Inheritor", "Haunted One", "Bounty Hunter", "Explorer", "Watcher", "Traveler", "Phantom", "Vigilante")
+genders = ("Male", "Female", "Non-binary")
+image_styles = ("Standard", "8bit Style", "Anime Style")
+themes = ("Fantasy / Medieval", "Steampunk", "Post-Apocalyptic","Cyberpunk","Dark Fantasy","Sci-Fi")
+# Draft is roughly a quarter of the cost and latency of a 1024px DALL·E 3 portrait
+portrait_qualities = {
+    "Draft": {"model": "dall-e-2", "size": "512x512"},
+    "Standard": {"model": "dall-e-3", "size": "1024x1024", "quality": "standard"},
+    "High": {"model": "dall-e-3", "size": "1024x1024", "quality": "hd"},
+}
+# Fast mode fills NPCs and quests from these tables instead of calling the model
+npc_first_names = ("Aldric", "Brenna", "Corwin", "Dara", "Edric", "Fenna", "Garrick", "Hilde", "Ivor", "Jora", "Kael", "Liora", "Madoc", "Nessa", "Orin", "Perrin", "Quilla", "Rowan", "Sable", "Tamsin")
+npc_roles = ("merchant", "guard", "blacksmith", "innkeeper", "priest", "wizard", "hunter", "scholar", "smuggler", "healer", "bard", "ferryman")
+npc_backstory_templates = (
+    "{name} is a {role} who lost everything in a border war and trusts no one.",
+    "{name}, a {role}, keeps a secret that could topple the local lord.",
+    "{name} became a {role} after fleeing a cult that still hunts them.",
+    "{name} is a retired adventurer now working as a {role}, haunted by an old debt.",
+)
+quest_templates = (
+    ("Retrieve the {item}", "Recover the {item} from {place} before rival hunters claim it."),
+    ("Escort to {place}", "Guide a wary traveller carrying the {item} safely to {place}."),
+    ("The Silence at {place}", "Find out why no word has come from {place} since the {item} went missing."),
+    ("Destroy the {item}", "The {item} is corrupting {place}; break it before the next full moon."),
+)
+quest_items = ("Sunforged Blade", "Crown of Ash", "Lantern of Echoes", "Obsidian Codex", "Wyrm Egg", "Moonsilver Key")
+quest_places = ("the Drowned Abbey", "Gravemoor Pass", "the Sunken Market", "Thornwall Keep", "the Ember Wastes", "Hollowmere")
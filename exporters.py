@@ -0,0 +1,192 @@
+import functools
+import os
+import tempfile
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+import orjson
+
+JOURNAL_INDEX = "journals.json"
+
+# reportlab is only needed once a PDF is built, so import it on first use rather than at startup
+@functools.lru_cache(maxsize=1)
+def _get_reportlab():
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfbase.pdfmetrics import stringWidth, getFont
+    return letter, canvas, ImageReader, stringWidth, getFont
+
+# Images are drawn at 400pt at most, so embedding the full 1024px DALL-E asset only bloats the PDF
+PDF_IMAGE_SIZE = 800
+
+# Decoding and downscaling happen in Pillow's C code, so a PDF's images are prepared side by side
+@st.cache_resource
+def _image_executor():
+    return ThreadPoolExecutor(max_workers=4)
+
+PDF_JPEG_QUALITY = 80
+
+# Every PDF that shows an image reuses its downscaled copy instead of decoding the original again.
+# JPEG is embedded as-is by reportlab, so the PDF carries the compressed file, not raw pixels.
+@st.cache_data(max_entries=256, show_spinner=False)
+def _pdf_image_bytes(image):
+    from PIL import Image
+    img = Image.open(BytesIO(image)).convert("RGB")
+    img.thumbnail((PDF_IMAGE_SIZE, PDF_IMAGE_SIZE), Image.LANCZOS)
+    buffer = BytesIO()
+    img.save(buffer, "JPEG", quality=PDF_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+def pdf_image(image):
+    return _get_reportlab()[2](BytesIO(_pdf_image_bytes(image)))
+
+# Page layout shared by every PDF export
+MARGIN = 50
+TOP = 750
+MAX_WIDTH = 500
+LINE_HEIGHT = 12
+FONT_NAME = "Helvetica"
+BOLD_FONT_NAME = "Helvetica-Bold"
+FONT_SIZE = 8
+TITLE_FONT_SIZE = 10
+
+@st.cache_data(show_spinner=False)
+def _journal_index(mtime):
+    # mtime is only part of the cache key, so the file is re-read once per write
+    with open(JOURNAL_INDEX, "rb") as file:
+        return orjson.loads(file.read())
+
+def load_journals():
+    if not os.path.exists(JOURNAL_INDEX):
+        return {}
+    return _journal_index(os.path.getmtime(JOURNAL_INDEX))
+
+@st.cache_resource
+def _journal_lock():
+    return threading.Lock()
+
+def save_journal(world_name, journal_text):
+    # The index is read, updated and rewritten, so sessions saving at once take turns
+    with _journal_lock():
+        journals = load_journals()
+        journals[world_name] = journal_text
+        write_json_atomic(JOURNAL_INDEX, journals)
+
+def create_journal_pdf(journal_text, characters):
+    letter, canvas = _get_reportlab()[:2]
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=letter)
+    x, y = MARGIN, TOP
+
+    # Journal text
+    y = draw_section(c, "World Journal", journal_text, y)
+
+    # Images of characters
+    for ch in characters:
+        c.setFont(BOLD_FONT_NAME, 9)
+        c.drawString(x, y, f"Character: {ch['character']['Name']}")
+        y -= LINE_HEIGHT
+        for img in _image_executor().map(pdf_image, ch["images"].values()):
+            if img:
+                if y - 300 < 0:
+                    c.showPage()
+                    y = TOP
+                c.drawImage(img, x, y - 250, width=250, height=250, preserveAspectRatio=True)
+                y -= 270
+        y -= LINE_HEIGHT
+
+    c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+# Standard-font widths are plain sums of glyph widths, so measure each word once and add
+# them up instead of re-measuring the whole growing line for every word
+@functools.lru_cache(maxsize=8)
+def _ascii_widths(font_size=FONT_SIZE):
+    # The font's own width table is in 1/1000 em; ASCII codes match WinAnsi, so scale it directly
+    widths = _get_reportlab()[4](FONT_NAME).widths
+    return tuple(width * font_size / 1000 for width in widths[:128])
+
+@functools.lru_cache(maxsize=4096)
+def word_width(word, font_size=FONT_SIZE):
+    if word.isascii():
+        widths = _ascii_widths(font_size)
+        return sum(widths[ord(ch)] for ch in word)
+    return _get_reportlab()[3](word, FONT_NAME, font_size)
+
+def wrap_text(text, max_width, font_size=FONT_SIZE):
+    space_width = word_width(" ", font_size)
+    lines = []
+    # Wrap each paragraph on its own so line breaks in the text are kept
+    for paragraph in text.split("\n") if text else ():
+        line, line_width = [], 0
+        for word in paragraph.split():
+            width = word_width(word, font_size)
+            test_width = line_width + space_width + width if line else width
+            if test_width > max_width and line:
+                lines.append(" ".join(line))
+                line, line_width = [word], width
+            else:
+                line.append(word)
+                line_width = test_width
+        lines.append(" ".join(line))
+    return lines
+
+def draw_wrapped_text(canvas, text, x, y, max_width, line_height, font_size=FONT_SIZE):
+    lines = wrap_text(text, max_width, font_size)
+    if not lines:
+        return y
+    # Emit the whole block as one PDF text object rather than a drawString per line
+    text_object = canvas.beginText(x, y)
+    text_object.setLeading(line_height)
+    text_object.textLines(lines)
+    canvas.drawText(text_object)
+    return y - line_height * len(lines)
+
+def draw_section(c, title, content, y):
+    c.setFont(BOLD_FONT_NAME, TITLE_FONT_SIZE)
+    c.drawString(MARGIN, y, title)
+    y -= LINE_HEIGHT
+    c.setFont(FONT_NAME, FONT_SIZE)
+    y = draw_wrapped_text(c, content, MARGIN, y, MAX_WIDTH, LINE_HEIGHT)
+    return y - LINE_HEIGHT
+
+def create_pdf(character, npc, quest, images):
+    letter, canvas = _get_reportlab()[:2]
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=letter)
+    x, y = MARGIN, TOP
+    for title, content in (
+        ("Character Info", f"{character['Name']} ({character['Gender']}, {character['Race']}, {character['Class']})"),
+        ("Background", character['Background']),
+        ("History", character.get('History', '')),
+        ("NPC", f"{npc['name']} - {npc['role']}"),
+        ("NPC Backstory", npc['backstory']),
+        ("Quest", quest['title']),
+        ("Quest Description", quest['description']),
+    ):
+        y = draw_section(c, title, content, y)
+    for img in _image_executor().map(pdf_image, images.values()):
+        if img:
+            if y - 270 < 0: c.showPage(); y = TOP
+            c.drawImage(img, x, y - 400, width=400, height=400, preserveAspectRatio=True)
+            y -= 420
+    c.showPage(); c.save()
+    return buffer.getvalue()
+
+def write_json_atomic(file_name, data):
+    # Write next to the target and swap it in, so readers never see a half-written file; each
+    # write gets a temp file of its own, so concurrent writers never interleave in one
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(file_name) or ".", suffix=".tmp", delete=False) as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE))
+    os.replace(f.name, file_name)
+
+# Single worker so background writes to the same file stay in order
+@st.cache_resource
+def _io_executor():
+    return ThreadPoolExecutor(max_workers=1)
+
+def save_to_json(character, npc, quest, file_name="character_data.json"):
+    return _io_executor().submit(write_json_atomic, file_name, {"character": character, "npc": npc, "quest": quest})
@@ -0,0 +1,720 @@
+import random
+import asyncio
+import base64
+import hashlib
+import os
+import orjson
+import shelve
+import tempfile
+import threading
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import openai
+from openai.api_resources.abstract import CreateableAPIResource
+import aiohttp
+from api_client import HTTP_CONCURRENCY, REQUEST_TIMEOUT, api_retry
+from semantic_cache import semantic_lookup, semantic_store
+from constants import (races, classes, backgrounds, genders, portrait_qualities, npc_first_names, npc_roles,
+                       npc_backstory_templates, quest_templates, quest_items, quest_places)
+
+# System prompts, kept byte-identical across calls and always sent first so the
+# provider can reuse its cached prompt prefix
+SYS_HISTORY = "You are a creative storyteller who writes lore for video game worlds. Write a short character backstory; any setting given must shape the story."
+SYS_LORE = "You are a fantasy world-building assistant."
+SYS_WORLD_LORE = ("You are a fantasy world-building assistant. You are given a JSON object mapping region keys to region briefs. "
+                  "Follow each brief and reply only with a JSON object mapping every region key to its lore text.")
+SYS_PARTY = "You are a fantasy storyteller. Continue the party's adventure in the style of George RR Martin, picking up where the existing story leaves off."
+SYS_CAST = ('Invent unique fantasy NPCs and quests. Reply only with JSON: {"npcs": [{"name": ..., "role": ..., "backstory": ...}], '
+            '"quests": [{"title": ..., "description": ...}]}, with exactly the number of each asked for.')
+SYS_REGION = ("You are a fantasy world-building assistant. Using the world journal, NPCs, quests and party stories you are given, "
+              "generate a unique fantasy region that is not one of the existing regions. Return a JSON object with 'name' and 'description'. The 'description' itself should "
+              "be a JSON object with keys: 'terrain', 'climate', 'special_features', 'quests', 'npcs'. ONLY RETURN JSON.")
+SYS_NPC_NAMES = ('Invent unique fantasy NPCs with varied roles such as merchants, warriors, scholars and mystics. '
+                 'Reply only with JSON: {"npcs": [{"name": ..., "role": ..., "backstory": ...}]}, with exactly the number asked for.')
+SYS_LOCATION_NAMES = ('Invent unique fantasy locations of different kinds, such as towns, ancient ruins, mystical forests and mountain strongholds. '
+                      'Reply only with JSON: {"locations": [{"name": ..., "description": ...}]}, with exactly the number asked for.')
+
+@api_retry
+def chat_completion(**kwargs):
+    return openai.ChatCompletion.create(request_timeout=REQUEST_TIMEOUT, **kwargs)
+
+@api_retry
+async def achat_completion(**kwargs):
+    return await openai.ChatCompletion.acreate(request_timeout=REQUEST_TIMEOUT, **kwargs)
+
+@api_retry
+async def aimage_completion(**kwargs):
+    return await openai.Image.acreate(request_timeout=REQUEST_TIMEOUT, **kwargs)
+
+# Persistent response cache, shared by every session so it survives reruns and restarts
+RESPONSE_CACHE = "cache.db"
+
+@st.cache_resource
+def _response_cache_lock():
+    return threading.Lock()
+
+def cache_get(key):
+    with _response_cache_lock(), shelve.open(RESPONSE_CACHE) as db:
+        return db.get(key)
+
+def cache_set(key, value):
+    with _response_cache_lock(), shelve.open(RESPONSE_CACHE) as db:
+        db[key] = value
+
+def chat_cache_key(model, messages, **kwargs):
+    payload = orjson.dumps({"model": model, "messages": messages, **kwargs}, option=orjson.OPT_SORT_KEYS)
+    return f"chat|{hashlib.sha256(payload).hexdigest()}"
+
+# For completions whose output should depend only on the prompt. Repeated prompts are answered
+# from memory within the process and from the response cache across restarts. Not for
+# calls that are meant to vary on every click, such as NPCs, quests or images.
+# Prompts carrying free text the user wrote can also name a semantic namespace: an exact miss
+# then reuses the response to a near-identical prompt, such as a journal with one word changed.
+@st.cache_data(max_entries=256, show_spinner=False)
+def cached_chat(model, messages, semantic=None, **kwargs):
+    key = chat_cache_key(model, messages, **kwargs)
+    cached = cache_get(key)
+    if cached:
+        return cached
+    if semantic:
+        cached, vector = semantic_lookup(semantic, "\n".join(m["content"] for m in messages if m["role"] == "user"))
+        if cached:
+            cache_set(key, cached)
+            return cached
+    response = chat_completion(model=model, messages=messages, **kwargs)
+    content = response['choices'][0]['message']['content']
+    cache_set(key, content)
+    if semantic:
+        semantic_store(semantic, vector, content)
+    return content
+
+# openai 0.28 predates the Batch API, so expose the endpoint as a plain create/retrieve resource
+class Batch(CreateableAPIResource):
+    OBJECT_NAME = "batches"
+
+def submit_chat_batch(bodies):
+    lines = [orjson.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}) for custom_id, body in bodies.items()]
+    batch_file = openai.File.create(file=BytesIO(b"\n".join(lines)), purpose="batch", user_provided_filename="batch.jsonl")
+    batch = Batch.create(input_file_id=batch_file["id"], endpoint="/v1/chat/completions", completion_window="24h")
+    return batch["id"]
+
+# Batches in these states will never produce output, so their ids can be dropped
+BATCH_FAILED_STATES = ("failed", "expired", "cancelled")
+
+class BatchFailedError(Exception):
+    pass
+
+def collect_chat_batch(batch_id):
+    # Returns ({custom_id: content}, {custom_id: error}) once the batch has completed, None while
+    # it is still running. Raises BatchFailedError if it failed, expired or was cancelled.
+    batch = Batch.retrieve(batch_id)
+    if batch["status"] in BATCH_FAILED_STATES:
+        reasons = [error.get("message", "") for error in (batch.get("errors") or {}).get("data") or []]
+        raise BatchFailedError(f"Batch {batch['status']}" + (f": {'; '.join(reasons)}" if reasons else ""))
+    if batch["status"] != "completed":
+        return None
+    # Successful requests land in the output file and failed ones in the error file; either may be missing
+    results, errors = {}, {}
+    for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+        if not file_id:
+            continue
+        for line in openai.File.download(file_id).splitlines():
+            item = orjson.loads(line)
+            response = item.get("response") or {}
+            if response.get("status_code") == 200:
+                results[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+            else:
+                error = item.get("error") or (response.get("body") or {}).get("error") or {}
+                errors[item["custom_id"]] = error.get("message") or f"status {response.get('status_code')}"
+    return results, errors
+
+# Generation functions
+def generate_character(name, gender, race, character_class, background):
+    return {"Name": name, "Gender": gender, "Race": race, "Class": character_class, "Background": background}
+
+def generate_many_characters(n, race_dist=None, seed=None):
+    # Draw every trait for all n characters in one call each; a dedicated Random keeps
+    # seeded runs reproducible without touching the global random state
+    rng = random.Random(seed)
+    race_weights = [race_dist.get(race, 0) for race in races] if race_dist else None
+    traits = zip(rng.choices(genders, k=n), rng.choices(races, weights=race_weights, k=n),
+                 rng.choices(classes, k=n), rng.choices(backgrounds, k=n))
+    return [generate_character(f"Adventurer {i+1}", gender, race, character_class, background)
+            for i, (gender, race, character_class, background) in enumerate(traits)]
+
+def history_theme_text(theme):
+    # Only modify prompt if a theme was selected
+    return f", setting={theme}" if theme and "Default" not in theme else ""
+
+# Backstories are written with this marker in place of the character's name and the name is
+# filled in afterwards, so one entry serves every character sharing gender, race, class,
+# background and setting
+HISTORY_NAME_PLACEHOLDER = "[[NAME]]"
+
+def history_key(gender, race, character_class, background, theme_text):
+    digest = hashlib.sha256("|".join((gender, race, character_class, background, theme_text)).encode("utf-8")).hexdigest()
+    return f"history|{digest}"
+
+# Built once: the system message is shared by every history request and the user prompt
+# is filled from a fixed template
+HISTORY_SYSTEM_MESSAGE = {"role": "system", "content": SYS_HISTORY}
+HISTORY_PROMPT = ("backstory for {gender} {race} {character_class}, bg={background}{theme_text}. "
+                  f"Refer to the character only as {HISTORY_NAME_PLACEHOLDER}, written exactly like that")
+
+def history_messages(gender, race, character_class, background, theme_text):
+    prompt = HISTORY_PROMPT.format(gender=gender, race=race, character_class=character_class, background=background, theme_text=theme_text)
+    return [HISTORY_SYSTEM_MESSAGE, {"role": "user", "content": prompt}]
+
+def history_traits(character, theme):
+    return character['Gender'], character['Race'], character['Class'], character['Background'], history_theme_text(theme)
+
+def fill_history_name(template, name):
+    return template.replace(HISTORY_NAME_PLACEHOLDER, name)
+
+def _stream_filled(chunks, name, parts):
+    # Swap the marker for the name as text streams in; a tail that could be the start of a
+    # marker split across chunks is held back until the next chunk settles it
+    pending = ""
+    for chunk in chunks:
+        parts.append(chunk)
+        pending = fill_history_name(pending + chunk, name)
+        hold = next((k for k in range(min(len(pending), len(HISTORY_NAME_PLACEHOLDER) - 1), 0, -1)
+                     if HISTORY_NAME_PLACEHOLDER.startswith(pending[-k:])), 0)
+        if len(pending) > hold:
+            yield pending[:len(pending) - hold]
+            pending = pending[len(pending) - hold:]
+    if pending:
+        yield pending
+
+def stream_character_history(character, theme=None, fresh=False):
+    # Yields the backstory as it is written. Identical characters reuse the stored backstory instead
+    # of paying for a new one; the traits are all picked from fixed lists, so the exact key covers
+    # every request. fresh skips the cache and writes a new backstory, which then replaces the cached one.
+    traits = history_traits(character, theme)
+    key = history_key(*traits)
+    cached = None if fresh else cache_get(key)
+    if cached:
+        yield fill_history_name(cached, character['Name'])
+        return
+
+    parts = []
+    yield from _stream_filled(stream_chat(model="gpt-4o-mini", messages=history_messages(*traits), max_tokens=250),
+                              character['Name'], parts)
+    cache_set(key, "".join(parts))
+
+# Worker threads per pool, shared by every session. Default-pool jobs mostly wait on the network,
+# so there is room for several users generating at once. MusicGen holds the machine for seconds
+# per song, so songs queue on a pool of their own and never delay work a rerun is waiting on.
+BACKGROUND_POOLS = {"default": 16, "music": 1}
+
+@st.cache_resource
+def _background_executor(pool):
+    return ThreadPoolExecutor(max_workers=BACKGROUND_POOLS[pool])
+
+def run_in_background(fn, *args, pool="default"):
+    # Run fn on a worker thread that can still use st.session_state; returns a future
+    ctx = get_script_run_ctx()
+    def call():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+    return _background_executor(pool).submit(call)
+
+# World Builder Functions
+
+def _list_schema(name, key, fields):
+    # Structured-output format for {key: [{field: string, ...}]}; strict mode guarantees the shape
+    item = {"type": "object", "properties": {field: {"type": "string"} for field in fields},
+            "required": list(fields), "additionalProperties": False}
+    schema = {"type": "object", "properties": {key: {"type": "array", "items": item}},
+              "required": [key], "additionalProperties": False}
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+NPC_NAMES_FORMAT = _list_schema("npc_names", "npcs", ("name", "role", "backstory"))
+LOCATION_NAMES_FORMAT = _list_schema("location_names", "locations", ("name", "description"))
+
+def npc_names_messages(count=10):
+    return [{"role": "system", "content": SYS_NPC_NAMES}, {"role": "user", "content": f"npcs={count}"}]
+
+def parse_npc_names(content):
+    return orjson.loads(content).get("npcs", []) if content else []
+
+def location_names_messages(count=10):
+    return [{"role": "system", "content": SYS_LOCATION_NAMES}, {"role": "user", "content": f"locations={count}"}]
+
+def parse_location_names(content):
+    return orjson.loads(content).get("locations", []) if content else []
+
+# NPC and location pools are filled through the Batch API, off the interactive path
+def submit_names_batch(count=10):
+    batch_id = submit_chat_batch({
+        "npcs": {"model": "gpt-4o-mini", "messages": npc_names_messages(count), "response_format": NPC_NAMES_FORMAT},
+        "locations": {"model": "gpt-4o-mini", "messages": location_names_messages(count), "response_format": LOCATION_NAMES_FORMAT},
+    })
+    st.session_state.names_batch = batch_id
+    return batch_id
+
+def check_names_batch():
+    # None while the batch is running, otherwise the errors to report (empty if all went through)
+    try:
+        collected = collect_chat_batch(st.session_state.names_batch)
+    except BatchFailedError as e:
+        del st.session_state.names_batch
+        return [str(e)]
+    if collected is None:
+        return None
+    results, errors = collected
+    st.session_state.setdefault("npcs", []).extend(parse_npc_names(results.get("npcs", "")))
+    st.session_state.setdefault("locations", []).extend(parse_location_names(results.get("locations", "")))
+    del st.session_state.names_batch
+    return [f"{kind}: {error}" for kind, error in errors.items()]
+
+
+_REGION_TEMPLATE = {"name": None, "characters": [], "npcs": [], "quests": [], "capital": False, "special_traits": []}
+
+def initialize_world(world_name):
+    # The list fields are re-created per region so regions never share them with the template
+    world = {"name": world_name, "regions": {
+        f"{i+1}-{j+1}": {**_REGION_TEMPLATE, "name": f"Location {i+1}-{j+1}", "characters": [], "npcs": [], "quests": [], "special_traits": []}
+        for i in range(5) for j in range(5)
+    }}
+    st.session_state.worlds[world_name] = world
+    return world
+
+def add_to_region(world_name, region_key, entry_type, entry):
+    st.session_state.worlds[world_name]["regions"][region_key][entry_type].append(entry)
+
+LORE_CONCURRENCY = 8
+# One completion writes all of its regions' lore in sequence, so a few regions per request
+# keeps each reply short while the requests run in parallel
+LORE_CHUNK_SIZE = 5
+
+def region_lore_prompt(region):
+    prompt = f"Generate a fantasy description of the region '{region['name']}' using the following elements:\n"
+    prompt += "Characters:\n" + "\n".join([f"- {c['Name']} ({c['Race']} {c['Class']})" for c in region["characters"]]) + "\n" if region["characters"] else ""
+    prompt += "NPCs:\n" + "\n".join([f"- {npc['name']} ({npc['role']})" for npc in region["npcs"]]) + "\n" if region["npcs"] else ""
+    prompt += "Quests:\n" + "\n".join([f"- {quest['title']}: {quest['description']}" for quest in region["quests"]]) + "\n" if region["quests"] else ""
+    prompt += "Generate a rich, detailed story or lore for this region based on these elements, adding mystery, drama, or historical context.\n"
+    return prompt
+
+def region_lore_messages(prompt):
+    return [{"role": "system", "content": SYS_LORE},
+            {"role": "user", "content": prompt}]
+
+async def _region_lore_chunk(prompts, semaphore):
+    async with semaphore:
+        response = await achat_completion(
+            model="gpt-4o-mini",
+            messages=[{"role": "system", "content": SYS_WORLD_LORE},
+                      {"role": "user", "content": orjson.dumps(prompts).decode("utf-8")}],
+            response_format={"type": "json_object"}
+        )
+    # A reply cut off at the token limit does not parse; its regions are then asked for one by one
+    try:
+        return orjson.loads(response['choices'][0]['message']['content'])
+    except orjson.JSONDecodeError:
+        return {}
+
+async def _region_lore(prompt, semaphore):
+    async with semaphore:
+        response = await achat_completion(model="gpt-4o-mini", messages=region_lore_messages(prompt))
+    return response['choices'][0]['message']['content']
+
+async def generate_world_lore(world, semaphore=None):
+    # Returns {region_key: lore} for every populated region. Lore is cached by the region's prompt,
+    # so a region is only requested again once its contents change (a completed batch fills the
+    # same cache); the rest are sent a few regions per JSON completion, run side by side.
+    lore, prompts = {}, {}
+    for key, region in world["regions"].items():
+        if region["characters"] or region["quests"]:
+            prompt = region_lore_prompt(region)
+            cached = cache_get(f"lore|{prompt}")
+            if cached:
+                lore[key] = cached
+            else:
+                prompts[key] = prompt
+    if not prompts:
+        return lore
+
+    semaphore = semaphore or asyncio.Semaphore(LORE_CONCURRENCY)
+    keys = list(prompts)
+    chunks = [{key: prompts[key] for key in keys[i:i + LORE_CHUNK_SIZE]} for i in range(0, len(keys), LORE_CHUNK_SIZE)]
+    written = {}
+    for results in await asyncio.gather(*[_region_lore_chunk(chunk, semaphore) for chunk in chunks]):
+        written.update((key, text) for key, text in results.items() if key in prompts and isinstance(text, str))
+    # Regions the model left out or renamed get a request of their own
+    missing = [key for key in keys if key not in written]
+    written.update(zip(missing, await asyncio.gather(*[_region_lore(prompts[key], semaphore) for key in missing])))
+    for key, text in written.items():
+        lore[key] = text
+        cache_set(f"lore|{prompts[key]}", text)
+    return lore
+
+async def generate_world_journal(world, semaphore=None):
+    lore = await generate_world_lore(world, semaphore)
+
+    journal_entries = []
+    for region_key, region in world["regions"].items():
+        parts = [f"**{region['name']}**"]
+        
+        # Include capital city info
+        if region["capital"]:
+            parts.append("Capital Region")
+        
+        # Add special traits or lore to the region
+        if region["special_traits"]:
+            parts.append("Special Traits:")
+            parts.extend(f"- {trait}" for trait in region["special_traits"])
+        
+        # Add characters info
+        if region["characters"]:
+            parts.append("Characters:")
+            parts.extend(f"- {c['Name']} ({c['Race']} {c['Class']}) - Last Seen: {c.get('last_action', 'Unknown')}" for c in region["characters"])
+        
+        # Add NPC info
+        if region["npcs"]:
+            parts.append("NPCs:")
+            parts.extend(f"- {npc['name']} ({npc['role']}) - Last Seen: {npc.get('last_action', 'Unknown')}" for npc in region["npcs"])
+        
+        # Add quests info
+        if region["quests"]:
+            parts.append("Quests:")
+            parts.extend(f"- {quest['title']} - Last Update: {quest.get('last_action', 'Unknown')}" for quest in region["quests"])
+        
+        # AI-generated regional content based on stories, characters, and quests
+        if region_key in lore:
+            parts.append(f"Lore/Story:\n{lore[region_key]}")
+        
+        journal_entries.append("\n".join(parts) + "\n")
+    
+    return "\n\n".join(journal_entries)
+
+def run_async(*coros):
+    # Run coroutines side by side in one event loop. acreate opens a new aiohttp session
+    # per call unless one is set for the loop, so share one across the whole batch.
+    async def gather_all():
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_CONCURRENCY)) as session:
+            openai.aiosession.set(session)
+            return await asyncio.gather(*coros)
+    return asyncio.run(gather_all())
+
+def generate_world_journals(worlds):
+    # One event loop for all worlds so their lore requests overlap, capped to respect the API rate limit
+    semaphore = asyncio.Semaphore(LORE_CONCURRENCY)
+    return run_async(*[generate_world_journal(world, semaphore) for world in worlds])
+
+
+# Bulk lore goes through the Batch API: half the price of live calls, results within 24h
+def submit_lore_batch(world):
+    # Only regions whose current contents have no lore yet
+    prompts = {}
+    for key, region in world["regions"].items():
+        if region["characters"] or region["quests"]:
+            prompt = region_lore_prompt(region)
+            if not cache_get(f"lore|{prompt}"):
+                prompts[key] = prompt
+    if not prompts:
+        return None
+    batch_id = submit_chat_batch({key: {"model": "gpt-4o-mini", "messages": region_lore_messages(prompt)} for key, prompt in prompts.items()})
+    # The prompts are kept with the batch, so results are cached under the contents they were written
+    # for even if the regions change while the batch runs
+    st.session_state.setdefault("lore_batches", {})[world["name"]] = {"id": batch_id, "prompts": prompts}
+    return batch_id
+
+def check_lore_batch(world):
+    # None while the batch is running, otherwise the errors to report (empty if all went through)
+    batch = st.session_state.lore_batches[world["name"]]
+    try:
+        collected = collect_chat_batch(batch["id"])
+    except BatchFailedError as e:
+        del st.session_state.lore_batches[world["name"]]
+        return [str(e)]
+    if collected is None:
+        return None
+    results, errors = collected
+    for key, lore in results.items():
+        cache_set(f"lore|{batch['prompts'][key]}", lore)
+    del st.session_state.lore_batches[world["name"]]
+    return [f"{world['regions'][key]['name']}: {error}" for key, error in errors.items()]
+
+
+# Batch mode: a character's text requests are queued on it and sent together later,
+# at half the price of live calls with results within 24h
+def character_text_requests(character, theme, generate_history, generate_npc_text, generate_quest_text):
+    bodies = {}
+    if generate_history:
+        bodies["history"] = {"model": "gpt-4o-mini", "max_tokens": 250, "messages": history_messages(*history_traits(character, theme))}
+    if generate_npc_text or generate_quest_text:
+        n_npcs, n_quests = int(generate_npc_text), int(generate_quest_text)
+        bodies["cast"] = {"model": "gpt-4o-mini", "max_tokens": 200 * (n_npcs + n_quests), "response_format": {"type": "json_object"},
+                          "messages": support_cast_messages(n_npcs, n_quests)}
+    return bodies
+
+def submit_character_batch(characters):
+    bodies = {f"{kind}_{i}": body for i, data in enumerate(characters) for kind, body in data.get("pending", {}).items()}
+    if not bodies:
+        return None
+    batch_id = submit_chat_batch(bodies)
+    st.session_state.setdefault("character_batches", []).append(batch_id)
+    for data in characters:
+        data.pop("pending", None)
+    return batch_id
+
+def check_character_batches(characters):
+    # Fill in every finished batch; returns how many were collected and the errors to report
+    collected, errors = 0, []
+    for batch_id in list(st.session_state.get("character_batches", [])):
+        try:
+            batch = collect_chat_batch(batch_id)
+        except BatchFailedError as e:
+            st.session_state.character_batches.remove(batch_id)
+            errors.append(str(e))
+            continue
+        if batch is None:
+            continue
+        results, failed = batch
+        for custom_id, content in results.items():
+            kind, i = custom_id.rsplit("_", 1)
+            data = characters[int(i)]
+            if kind == "history":
+                data["character"]["History"] = fill_history_name(content, data["character"]["Name"])
+            else:
+                npcs, quests = parse_support_cast(content)
+                data["npc"] = npcs[0] if npcs else data["npc"]
+                data["quest"] = quests[0] if quests else data["quest"]
+        for custom_id, error in failed.items():
+            kind, i = custom_id.rsplit("_", 1)
+            errors.append(f"{characters[int(i)]['character']['Name']} ({kind}): {error}")
+        st.session_state.character_batches.remove(batch_id)
+        collected += 1
+    return collected, errors
+
+
+def stream_chat(**kwargs):
+    # Yield text deltas as they arrive; pass to st.write_stream to render from the first token
+    for chunk in chat_completion(stream=True, **kwargs):
+        yield chunk["choices"][0]["delta"].get("content", "")
+
+def party_story_messages(names, story=""):
+    # The story so far goes before the short instruction: it only ever grows by appending,
+    # so each continuation shares the previous call's prefix and hits the prompt cache
+    messages = [{"role": "system", "content": SYS_PARTY},
+                {"role": "user", "content": f"Party members: {', '.join(names)}."}]
+    if story:
+        messages.append({"role": "assistant", "content": story})
+    messages.append({"role": "user", "content": "Continue the story."})
+    return messages
+
+# Continuations are remembered per session, keyed on the party's members and the story so far,
+# so going back to a point in a party's story (e.g. by saving an earlier version) costs nothing
+def party_story_key(names, story=""):
+    return chat_cache_key("gpt-4o-mini", party_story_messages(names, story))
+
+def stream_party_story(names, story=""):
+    story_cache = st.session_state.setdefault("story_cache", {})
+    key = party_story_key(names, story)
+    if key in story_cache:
+        yield story_cache[key]
+        return
+    parts = []
+    for chunk in stream_chat(model="gpt-4o-mini", messages=party_story_messages(names, story)):
+        parts.append(chunk)
+        yield chunk
+    story_cache[key] = "".join(parts)
+
+async def acontinue_party_story(names, story=""):
+    response = await achat_completion(model="gpt-4o-mini", messages=party_story_messages(names, story))
+    return response['choices'][0]['message']['content']
+
+def continue_party_stories(parties):
+    # Continue every party at once: cached continuations are reused and the rest run side by side
+    story_cache = st.session_state.setdefault("story_cache", {})
+    pending = {party_story_key(names, story): (names, story) for names, story in parties}
+    missing = [key for key in pending if key not in story_cache]
+    if missing:
+        story_cache.update(zip(missing, run_async(*[acontinue_party_story(*pending[key]) for key in missing])))
+    return [story_cache[party_story_key(names, story)] for names, story in parties]
+
+# Extra direction appended to the base prompt for each kind of character image
+IMAGE_VARIANTS = {
+    "portrait": "",
+    "turnaround": " Character turnaround sheet: front, side and back views side by side.",
+    "location": " Wide shot of the character in their place of origin, with the surrounding landscape in view.",
+    "extra_1": " Alternate action pose.",
+    "extra_2": " Alternate outfit.",
+    "extras": " Alternate action pose and outfit.",
+}
+
+def character_image_prompt(character, style="Standard", theme=None, variant="portrait"):
+    theme_text = f"in a {theme} world, " if theme and "Default" not in theme else ""
+    
+    base_prompt = (
+        f"A full-body portrait of a {character['Gender']} {character['Race']} {character['Class']}, "
+        f"{theme_text}wearing detailed clothing that matches their background. "
+        f"High-quality concept art, consistent lighting, dynamic pose."
+    )
+    base_prompt += IMAGE_VARIANTS[variant]
+
+    # Keep your existing style logic
+    if style == "8bit Style": base_prompt += " Pixel art, 8-bit sprite."
+    elif style == "Anime Style": base_prompt += " Anime cel-shaded style."
+    elif style == "Realistic Style": base_prompt += " Realistic fantasy rendering."
+    return base_prompt
+
+def image_key(character, style, theme, quality, variant):
+    return (character['Name'], character['Race'], character['Class'], character['Gender'], style, theme, quality, variant)
+
+# Generated images are also kept on disk, so a restart or a new session reuses them
+IMAGE_CACHE_DIR = "cache"
+
+def _image_cache_path(key):
+    return os.path.join(IMAGE_CACHE_DIR, hashlib.sha256(repr(key).encode("utf-8")).hexdigest() + ".png")
+
+def load_cached_image(key):
+    path = _image_cache_path(key)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+def store_cached_image(key, image):
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    # A temp file of its own per write, so threads storing the same key never share one
+    with tempfile.NamedTemporaryFile(dir=IMAGE_CACHE_DIR, suffix=".tmp", delete=False) as f:
+        f.write(image)
+    os.replace(f.name, _image_cache_path(key))
+
+def forget_character_images(character, style, theme, quality, variants):
+    # Drop a character's cached images so the next generation asks the API for new ones
+    image_cache = st.session_state.setdefault("image_cache", {})
+    for variant in ["portrait", *variants]:
+        key = image_key(character, style, theme if variant == "portrait" else None, quality, variant)
+        image_cache.pop(key, None)
+        try:
+            os.remove(_image_cache_path(key))
+        except FileNotFoundError:
+            pass
+
+async def agenerate_character_image(character, style="Standard", theme=None, quality="Draft", variant="portrait"):
+    image_cache = st.session_state.setdefault("image_cache", {})
+    key = image_key(character, style, theme, quality, variant)
+    if key not in image_cache:
+        image = load_cached_image(key)
+        if image is None:
+            # Ask for the image inline: no URL to expire and no second request to fetch the bytes
+            response = await aimage_completion(prompt=character_image_prompt(character, style, theme, variant),
+                                               response_format="b64_json", **portrait_qualities[quality])
+            image = base64.b64decode(response["data"][0]["b64_json"])
+            store_cached_image(key, image)
+        image_cache[key] = image
+    return image_cache[key]
+
+async def agenerate_extra_images(character, style="Standard", quality="Draft", count=2):
+    # dall-e-2 returns all the extras from one request with n; dall-e-3 only makes one image per call
+    if portrait_qualities[quality]["model"] != "dall-e-2":
+        return await asyncio.gather(*[agenerate_character_image(character, style, None, quality, f"extra_{i+1}") for i in range(count)])
+    image_cache = st.session_state.setdefault("image_cache", {})
+    keys = [image_key(character, style, None, quality, f"extra_{i+1}") for i in range(count)]
+    for key in keys:
+        if key not in image_cache and (image := load_cached_image(key)) is not None:
+            image_cache[key] = image
+    missing = [key for key in keys if key not in image_cache]
+    if missing:
+        response = await aimage_completion(prompt=character_image_prompt(character, style, None, "extras"), n=len(missing),
+                                           response_format="b64_json", **portrait_qualities[quality])
+        for key, item in zip(missing, response["data"]):
+            image = base64.b64decode(item["b64_json"])
+            store_cached_image(key, image)
+            image_cache[key] = image
+    return [image_cache.get(key) for key in keys]
+
+def support_cast_messages(n_npcs, n_quests):
+    return [{"role": "system", "content": SYS_CAST}, {"role": "user", "content": f"npcs={n_npcs}, quests={n_quests}"}]
+
+def parse_support_cast(content):
+    cast = orjson.loads(content)
+    return cast.get("npcs", []), cast.get("quests", [])
+
+async def agenerate_support_cast(n_npcs, n_quests):
+    # Every NPC and quest comes back from one JSON completion instead of a request each
+    if not n_npcs and not n_quests:
+        return [], []
+    response = await achat_completion(
+        model="gpt-4o-mini",
+        messages=support_cast_messages(n_npcs, n_quests),
+        response_format={"type": "json_object"},
+        max_tokens=200 * (n_npcs + n_quests)
+    )
+    return parse_support_cast(response["choices"][0]["message"]["content"])
+
+# Stand-ins for a character whose NPC or quest text was not generated
+PLACEHOLDER_NPC = {"name": "Unknown", "role": "Unknown", "backstory": "No backstory provided."}
+PLACEHOLDER_QUEST = {"title": "Untitled Quest", "description": "No description provided."}
+
+# Fast mode: filler NPCs and quests built locally from template tables, with no network call
+def template_npc(rng=random):
+    name, role = rng.choice(npc_first_names), rng.choice(npc_roles)
+    return {"name": name, "role": role, "backstory": rng.choice(npc_backstory_templates).format(name=name, role=role)}
+
+def template_quest(rng=random):
+    title, description = rng.choice(quest_templates)
+    parts = {"item": rng.choice(quest_items), "place": rng.choice(quest_places)}
+    return {"title": title.format(**parts), "description": description.format(**parts)}
+
+# Theme songs come from MusicGen running locally; the model takes tens of seconds to load,
+# so it is loaded once per process and shared by every session
+THEME_SONG_SECONDS = 10
+MUSICGEN_TOKENS_PER_SECOND = 50
+
+@st.cache_resource(show_spinner=False)
+def _load_musicgen():
+    from transformers import AutoProcessor, MusicgenForConditionalGeneration
+    processor = AutoProcessor.from_pretrained("facebook/musicgen-small")
+    model = MusicgenForConditionalGeneration.from_pretrained("facebook/musicgen-small")
+    return processor, model
+
+def theme_song_prompt(character, theme=None):
+    setting = theme if theme and "Default" not in theme else "medieval fantasy"
+    return f"{setting} theme music for a {character['Race']} {character['Class']}, {character['Background'].lower()} background, orchestral, cinematic"
+
+def generate_theme_songs(characters, theme=None):
+    # One batched generate call for every character; returns WAV bytes in the same order
+    if not characters:
+        return []
+    processor, model = _load_musicgen()
+    inputs = processor(text=[theme_song_prompt(character, theme) for character in characters], padding=True, return_tensors="pt")
+    audio = model.generate(**inputs, max_new_tokens=THEME_SONG_SECONDS * MUSICGEN_TOKENS_PER_SECOND)
+    sampling_rate = model.config.audio_encoder.sampling_rate
+    songs = []
+    for samples in audio[:, 0].numpy():
+        buffer = BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(sampling_rate)
+            wav.writeframes((samples.clip(-1, 1) * 32767).astype("<i2").tobytes())
+        songs.append(buffer.getvalue())
+    return songs
+
+def generate_theme_song(character, theme=None):
+    return generate_theme_songs([character], theme)[0]
+
+async def build_character_bundle(char, style, quality, theme, variants, generate_npc_text, generate_quest_text):
+    # The NPC, quest and image calls are independent, so run them side by side through the
+    # async client and the shared session; run this via run_async. The history is streamed
+    # separately by stream_character_history.
+    extras = [variant for variant in variants if variant.startswith("extra_")]
+    views = [variant for variant in variants if variant not in extras]
+    (npcs, quests), extra_images, *images = await asyncio.gather(
+        agenerate_support_cast(int(generate_npc_text), int(generate_quest_text)),
+        agenerate_extra_images(char, style, quality, len(extras)),
+        agenerate_character_image(char, style, theme, quality),
+        *[agenerate_character_image(char, style, None, quality, variant) for variant in views]
+    )
+    npc = npcs[0] if npcs else dict(PLACEHOLDER_NPC)
+    quest = quests[0] if quests else dict(PLACEHOLDER_QUEST)
+    # Images are labelled by variant so the UI and exports can tell a turnaround from a portrait
+    labelled = zip(["portrait", *views, *extras], [*images, *extra_images])
+    return npc, quest, {variant: image for variant, image in labelled if image}
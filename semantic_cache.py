@@ -0,0 +1,64 @@
+import os
+import pickle
+import tempfile
+import threading
+import numpy as np
+import streamlit as st
+import openai
+from api_client import REQUEST_TIMEOUT, api_retry
+
+# Near-duplicate prompts are answered from earlier responses: prompts are embedded and a stored
+# response is reused when its prompt's cosine similarity clears the threshold
+SEMANTIC_CACHE = os.path.join("cache", "semantic.pkl")
+EMBEDDING_MODEL = "text-embedding-3-small"
+SIMILARITY_THRESHOLD = 0.95
+# Entries kept per namespace; the least recently used are dropped first
+SEMANTIC_CACHE_SIZE = 1000
+# Text past this is not embedded; it keeps long journals under the embedding model's input limit
+EMBEDDING_MAX_CHARS = 24000
+
+@st.cache_resource
+def _semantic_store():
+    # {namespace: (unit vectors as an (n, d) array, responses)}, loaded once per process
+    try:
+        with open(SEMANTIC_CACHE, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return {}
+
+@st.cache_resource
+def _semantic_lock():
+    return threading.Lock()
+
+@api_retry
+def embed(text):
+    response = openai.Embedding.create(model=EMBEDDING_MODEL, input=text[:EMBEDDING_MAX_CHARS], request_timeout=REQUEST_TIMEOUT)
+    vector = np.asarray(response["data"][0]["embedding"], dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def semantic_lookup(namespace, text):
+    # Returns (response or None, embedding); pass the embedding on to semantic_store after a miss
+    vector = embed(text)
+    with _semantic_lock():
+        store = _semantic_store()
+        vectors, responses = store.get(namespace, (None, []))
+        if responses:
+            scores = vectors @ vector
+            best = int(scores.argmax())
+            if scores[best] >= SIMILARITY_THRESHOLD:
+                # Move the hit to the end, so entries stay ordered from least to most recently used
+                order = [*range(best), *range(best + 1, len(responses)), best]
+                store[namespace] = (vectors[order], [responses[i] for i in order])
+                return responses[best], vector
+    return None, vector
+
+def semantic_store(namespace, vector, response):
+    with _semantic_lock():
+        store = _semantic_store()
+        vectors, responses = store.get(namespace, (np.empty((0, vector.shape[0]), dtype=np.float32), []))
+        store[namespace] = (np.vstack([vectors, vector])[-SEMANTIC_CACHE_SIZE:], (responses + [response])[-SEMANTIC_CACHE_SIZE:])
+        os.makedirs(os.path.dirname(SEMANTIC_CACHE), exist_ok=True)
+        # The lock only covers this process, so each write still gets a temp file of its own
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(SEMANTIC_CACHE), suffix=".tmp", delete=False) as f:
+            pickle.dump(store, f)
+        os.replace(f.name, SEMANTIC_CACHE)